@@ -2,121 +2,244 @@ require('dotenv').config();
 const { Telegraf } = require('telegraf');
 const { Pool } = require('pg');
 
-// Подключение к Supabase
+// Подключение к Supabase.
+// SUPABASE_DB_URL может указывать на пулер Supavisor (порт 6543, transaction mode):
+// именованные prepared statements не используются, так что режим совместим.
 const pool = new Pool({
   connectionString: process.env.SUPABASE_DB_URL,
-  ssl: { rejectUnauthorized: false }
+  ssl: { rejectUnauthorized: false },
+  max: Number(process.env.DB_POOL_MAX) || 10,
+  idleTimeoutMillis: 30000,
+  connectionTimeoutMillis: 10000,
+  keepAlive: true
 });
 
+// Обрыв простаивающего соединения не должен ронять процесс
+pool.on('error', (err) => console.error('Ошибка соединения с БД:', err));
+
+// Ошибки, после которых запрос имеет смысл повторить: пулер закрыл соединение,
+// сервер перезапускается или сеть моргнула
+const TRANSIENT_DB_CODES = new Set([
+  'ECONNRESET', 'ECONNREFUSED', 'ETIMEDOUT', 'EPIPE',
+  '08000', '08003', '08006', '57P01', '57P02', '57P03'
+]);
+
+function isTransientDbError(err) {
+  return TRANSIENT_DB_CODES.has(err.code) || /Connection terminated/.test(err.message);
+}
+
+// pool.query с повтором и экспоненциальной задержкой; все запросы бота — чтение,
+// так что повтор безопасен
+async function dbQuery(text, params, attempts = 3) {
+  for (let i = 0; ; i++) {
+    try {
+      return await pool.query(text, params);
+    } catch (err) {
+      if (i === attempts - 1 || !isTransientDbError(err)) throw err;
+      await new Promise((resolve) => setTimeout(resolve, 100 * 2 ** i + Math.random() * 50));
+    }
+  }
+}
+
 const bot = new Telegraf(process.env.BOT_TOKEN);
 
-bot.start((ctx) => ctx.reply('Добро пожаловать! Используйте /help для списка команд.'));
-bot.help((ctx) => ctx.reply(
+// Условие «заказ активен»: задаётся в одном месте для всех запросов
+const ACTIVE_ORDER_SQL = `"Status" NOT IN ('Completed','Cancelled')`;
+
+// Сколько заказов показывать в /orders (сообщение Telegram ограничено 4096 символами)
+const ORDERS_LIST_LIMIT = 15;
+
+// Подписи статусов задач по значению "Status" (0, 1, 2)
+const TASK_STATUS_LABELS = ['🔴 To Do', '🟡 In Progress', '✅ Completed'];
+
+// Ответы с разметкой отправляются как HTML: в отличие от legacy Markdown,
+// достаточно экранировать три символа в данных из БД
+const HTML = { parse_mode: 'HTML' };
+const HTML_ESCAPES = { '&': '&amp;', '<': '&lt;', '>': '&gt;' };
+const escapeHtml = (value) => String(value).replace(/[&<>]/g, (c) => HTML_ESCAPES[c]);
+
+const pad2 = (n) => (n < 10 ? '0' : '') + n;
+
+// ДД.ММ.ГГГГ, как toLocaleDateString('ru'), но без локалей Intl.
+// pg уже отдаёт даты объектами Date — повторно разбираем только строки
+function formatDate(value, fallback) {
+  if (!value) return fallback;
+  const d = value instanceof Date ? value : new Date(value);
+  return `${pad2(d.getDate())}.${pad2(d.getMonth() + 1)}.${d.getFullYear()}`;
+}
+
+// Статические ответы собираются один раз при загрузке модуля
+const START_TEXT = 'Добро пожаловать! Используйте /help для списка команд.';
+const HELP_TEXT =
   'Доступные команды:\n' +
   '/orders - список активных заказов\n' +
   '/report - сводный отчёт\n' +
   '/order_123 - информация о заказе №123\n' +
-  '/tasks_123 - задачи по заказу №123'
-));
+  '/tasks_123 - задачи по заказу №123';
+
+bot.start((ctx) => ctx.reply(START_TEXT));
+bot.help((ctx) => ctx.reply(HELP_TEXT));
+
+// Короткоживущий кэш готовых ответов: повторные запросы в течение TTL отдаются
+// без обращения к БД, а одновременные ждут один и тот же запрос
+const CACHE_TTL_MS = 30000;
+const cache = new Map();
+const inFlight = new Map();
+
+function cached(key, build) {
+  const hit = cache.get(key);
+  if (hit && Date.now() - hit.ts < CACHE_TTL_MS) return Promise.resolve(hit.value);
+  let pending = inFlight.get(key);
+  if (!pending) {
+    pending = build()
+      .then((value) => {
+        cache.set(key, { ts: Date.now(), value });
+        return value;
+      })
+      .finally(() => inFlight.delete(key));
+    inFlight.set(key, pending);
+  }
+  return pending;
+}
+
+async function buildOrdersList() {
+  const res = await dbQuery(
+    // total — число всех активных заказов, считается в том же запросе до LIMIT
+    `SELECT "OrderNumber", "ClientName", "Status", "EtaDate", COUNT(*) OVER () AS total
+     FROM public."Orders" 
+     WHERE ${ACTIVE_ORDER_SQL}
+     ORDER BY "OrderNumber"
+     LIMIT $1`,
+    [ORDERS_LIST_LIMIT]
+  );
+  if (res.rows.length === 0) return 'Нет активных заказов.';
+  const total = Number(res.rows[0].total);
+  const lines = [`📦 <b>Активные заказы (${total}):</b>`, ''];
+  res.rows.forEach(o => {
+    lines.push(
+      `• ${escapeHtml(o.OrderNumber)} — ${escapeHtml(o.ClientName)}`,
+      `  Статус: ${escapeHtml(o.Status)}, ETA: ${formatDate(o.EtaDate, 'не указано')}`
+    );
+  });
+  if (total > res.rows.length) lines.push('', `…показаны первые ${res.rows.length} из ${total}`);
+  return lines.join('\n');
+}
 
 bot.command('orders', async (ctx) => {
   try {
-    const res = await pool.query(
-      `SELECT "OrderNumber", "ClientName", "Status", "EtaDate" 
-       FROM public."Orders" 
-       WHERE "Status" NOT IN ('Completed','Cancelled')
-       ORDER BY "OrderNumber"`
-    );
-    if (res.rows.length === 0) return ctx.reply('Нет активных заказов.');
-    let msg = '📦 **Активные заказы:**\n\n';
-    res.rows.forEach(o => {
-      msg += `• ${o.OrderNumber} — ${o.ClientName}\n  Статус: ${o.Status}, ETA: ${o.EtaDate ? new Date(o.EtaDate).toLocaleDateString('ru') : 'не указано'}\n`;
-    });
-    ctx.reply(msg);
+    ctx.reply(await cached('orders', buildOrdersList), HTML);
   } catch (err) {
     console.error(err);
     ctx.reply('Ошибка получения заказов.');
   }
 });
 
+async function buildReport() {
+  // Все агрегаты считаются на стороне БД за один запрос; "Orders" читается одним проходом
+  const res = await dbQuery(
+    `SELECT
+       COUNT(*) AS total,
+       COUNT(*) FILTER (WHERE ${ACTIVE_ORDER_SQL}) AS active,
+       SUM("ContainerCount") AS containers,
+       (SELECT SUM(c."Weight") FROM public."Containers" c) AS weight
+     FROM public."Orders"`
+  );
+  const r = res.rows[0];
+  return `📊 <b>Сводный отчёт</b>\n\n` +
+    `Всего заказов: ${r.total}\n` +
+    `Активных: ${r.active}\n` +
+    `Контейнеров: ${r.containers || 0}\n` +
+    `Общий вес: ${r.weight || 0} кг`;
+}
+
 bot.command('report', async (ctx) => {
   try {
-    const total = await pool.query(`SELECT COUNT(*) FROM public."Orders"`);
-    const active = await pool.query(`SELECT COUNT(*) FROM public."Orders" WHERE "Status" NOT IN ('Completed','Cancelled')`);
-    const containers = await pool.query(`SELECT SUM("ContainerCount") FROM public."Orders"`);
-    const weight = await pool.query(`SELECT SUM(c."Weight") FROM public."Containers" c`);
-    ctx.reply(
-      `📊 **Сводный отчёт**\n\n` +
-      `Всего заказов: ${total.rows[0].count}\n` +
-      `Активных: ${active.rows[0].count}\n` +
-      `Контейнеров: ${containers.rows[0].sum || 0}\n` +
-      `Общий вес: ${weight.rows[0].sum || 0} кг`
-    );
+    ctx.reply(await cached('report', buildReport), HTML);
   } catch (err) {
     console.error(err);
     ctx.reply('Ошибка формирования отчёта.');
   }
 });
 
-// Динамические команды
-bot.use(async (ctx, next) => {
-  const text = ctx.message?.text;
-  if (!text) return next();
-
-  const orderMatch = text.match(/^\/order_(\d+)$/);
-  if (orderMatch) {
-    const id = orderMatch[1];
-    try {
-      const order = await pool.query(
-        `SELECT * FROM public."Orders" WHERE "OrderNumber" = $1 OR "Id" = $1::int`,
-        [id]
-      );
-      if (order.rows.length === 0) return ctx.reply('Заказ не найден.');
-      const o = order.rows[0];
-      let msg = `🔹 **Заказ ${o.OrderNumber}**\n`;
-      msg += `Клиент: ${o.ClientName}\n`;
-      msg += `Тип груза: ${o.GoodsType || '—'}\n`;
-      msg += `Маршрут: ${o.Route || '—'}\n`;
-      msg += `Контейнеров: ${o.ContainerCount}\n`;
-      msg += `Статус: ${o.Status}\n`;
-      msg += `ETA: ${o.EtaDate ? new Date(o.EtaDate).toLocaleDateString('ru') : '—'}\n`;
-      msg += `TKM дата: ${o.TkmDate ? new Date(o.TkmDate).toLocaleDateString('ru') : '—'}`;
-      ctx.reply(msg);
-    } catch (err) {
-      ctx.reply('Ошибка получения заказа.');
-    }
-    return;
+// Динамические команды вида /order_123 и /tasks_123
+async function showOrder(ctx, id) {
+  try {
+    const order = await dbQuery(
+      `SELECT "OrderNumber", "ClientName", "GoodsType", "Route", "ContainerCount",
+              "Status", "EtaDate", "TkmDate"
+       FROM public."Orders"
+       WHERE "OrderNumber" = $1 OR "Id" = $1::int`,
+      [id]
+    );
+    if (order.rows.length === 0) return ctx.reply('Заказ не найден.');
+    const o = order.rows[0];
+    ctx.reply([
+      `🔹 <b>Заказ ${escapeHtml(o.OrderNumber)}</b>`,
+      `Клиент: ${escapeHtml(o.ClientName)}`,
+      `Тип груза: ${escapeHtml(o.GoodsType || '—')}`,
+      `Маршрут: ${escapeHtml(o.Route || '—')}`,
+      `Контейнеров: ${o.ContainerCount}`,
+      `Статус: ${escapeHtml(o.Status)}`,
+      `ETA: ${formatDate(o.EtaDate, '—')}`,
+      `TKM дата: ${formatDate(o.TkmDate, '—')}`
+    ].join('\n'), HTML);
+  } catch (err) {
+    console.error(err);
+    ctx.reply('Ошибка получения заказа.');
   }
+}
 
-  const tasksMatch = text.match(/^\/tasks_(\d+)$/);
-  if (tasksMatch) {
-    const id = tasksMatch[1];
-    try {
-      const tasks = await pool.query(
-        `SELECT t.*, o."OrderNumber" 
-         FROM public."Tasks" t 
-         JOIN public."Orders" o ON t."OrderId" = o."Id" 
-         WHERE o."OrderNumber" = $1 OR o."Id" = $1::int`,
-        [id]
+async function showTasks(ctx, id) {
+  try {
+    const tasks = await dbQuery(
+      `SELECT t."Description", t."Status", t."DueDate", o."OrderNumber" 
+       FROM public."Tasks" t 
+       JOIN public."Orders" o ON t."OrderId" = o."Id" 
+       WHERE o."OrderNumber" = $1 OR o."Id" = $1::int`,
+      [id]
+    );
+    if (tasks.rows.length === 0) return ctx.reply('Нет задач для этого заказа.');
+    const lines = [`📋 <b>Задачи по заказу ${escapeHtml(tasks.rows[0].OrderNumber)}:</b>`, ''];
+    tasks.rows.forEach(t => {
+      const status = TASK_STATUS_LABELS[t.Status] || 'Неизвестно';
+      lines.push(
+        `• ${escapeHtml(t.Description)}`,
+        `  ${status}, срок: ${formatDate(t.DueDate, '—')}`
       );
-      if (tasks.rows.length === 0) return ctx.reply('Нет задач для этого заказа.');
-      let msg = `📋 **Задачи по заказу ${tasks.rows[0].OrderNumber}:**\n\n`;
-      tasks.rows.forEach(t => {
-        const status = ['🔴 To Do', '🟡 In Progress', '✅ Completed'][t.Status] || 'Неизвестно';
-        msg += `• ${t.Description}\n  ${status}, срок: ${t.DueDate ? new Date(t.DueDate).toLocaleDateString('ru') : '—'}\n`;
-      });
-      ctx.reply(msg);
-    } catch (err) {
-      ctx.reply('Ошибка получения задач.');
-    }
-    return;
+    });
+    ctx.reply(lines.join('\n'), HTML);
+  } catch (err) {
+    console.error(err);
+    ctx.reply('Ошибка получения задач.');
   }
+}
+
+// Префикс команды -> обработчик; одно регулярное выражение на сообщение
+const DYNAMIC_COMMANDS = { order: showOrder, tasks: showTasks };
+const DYNAMIC_COMMAND_RE = /^\/(order|tasks)_(\d+)$/;
 
-  next();
+bot.use(async (ctx, next) => {
+  const text = ctx.message?.text;
+  const match = text && DYNAMIC_COMMAND_RE.exec(text);
+  if (!match) return next();
+  await DYNAMIC_COMMANDS[match[1]](ctx, match[2]);
 });
 
-// Запуск бота (long polling)
-bot.launch().then(() => console.log('Telegram bot started'));
+// Запуск бота: webhook, если известен публичный домен (например, на Railway),
+// иначе long polling
+const webhookDomain = process.env.WEBHOOK_DOMAIN || process.env.RAILWAY_PUBLIC_DOMAIN;
+const launchOptions = webhookDomain
+  ? {
+      webhook: {
+        domain: webhookDomain,
+        port: Number(process.env.PORT) || 8443,
+        secretToken: process.env.WEBHOOK_SECRET
+      }
+    }
+  : {};
+bot.launch(launchOptions).then(() =>
+  console.log(`Telegram bot started (${webhookDomain ? 'webhook' : 'long polling'})`)
+);
 
 // Graceful stop
 process.once('SIGINT', () => bot.stop('SIGINT'));